@@ -6,31 +6,60 @@ import socket
 import sys
 import os
 import re
-from dataclasses import dataclass, asdict
-from typing import Optional, Dict, List
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Tuple
 from functools import lru_cache
+from operator import attrgetter
 import time
+import heapq
 import signal
-from contextlib import contextmanager
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson  # optional: faster JSON output for the CLI
+except ImportError:
+    orjson = None
 
 # Config
 TOP_N = int(os.getenv('TOP_N', '50'))
 TIMEOUT_SEC = int(os.getenv('COLLECTOR_TIMEOUT', '30'))
 ENABLE_DISK_IO = os.getenv('ENABLE_DISK_IO', 'true').lower() == 'true'
+METADATA_WORKERS = int(os.getenv('METADATA_WORKERS', '8'))
+DOCKER_CONTAINERS_DIR = '/var/lib/docker/containers'
+CGROUP_PATH_MAX = 500
+LABEL_VALUE_MAX = 64  # command / container metadata, as exported in labels
+TSV_COLUMNS = 11  # fields per collector.sh row
+_INT_COLUMNS = (0, 4, 5, 7, 8)  # pid, rss_kb, uptime_sec, disk_read, disk_write
+CACHE_TTL = float(os.getenv('COLLECTOR_CACHE_TTL', '5'))
+
+# Resolved once per process lifetime instead of per row / per collection
+_HOSTNAME = socket.gethostname()
+_BASE_ENV = {**os.environ, 'TOP_N': str(TOP_N), 'FORMAT': 'tsv'}
+
+# Last successful collection; the lock also coalesces concurrent scrapes
+_LAST = {'t': 0.0, 'data': []}
+_LAST_LOCK = threading.Lock()
+
+# pid → (cgroup_path, runtime, container_id, container_name, pod_name, namespace)
+# from the previous cycle; only rows whose cgroup changed are re-classified
+_PID_CACHE: Dict[int, Tuple[str, str, str, str, str, str]] = {}
 
-@dataclass
+# Field order up to cgroup_path is pinned to collector.sh's TSV column order,
+# so a row maps onto the constructor positionally. Keep the two in sync.
+@dataclass(slots=True)
 class ProcessMetric:
-    pid: int    
+    pid: int
     user: str
-    command: str
-    cpu_pct: float
-    mem_pct: float  # NEW: % memory
+    cpu_pct_q: int  # % CPU in hundredths (collector.sh prints 2 decimals)
+    mem_pct_q: int  # % memory in hundredths
     mem_rss_kb: int
+    uptime_sec: int  # Renamed for Prometheus
+    command: str
     disk_read_bytes: int
-    disk_write_bytes: int    
+    disk_write_bytes: int
     ports: Optional[str]
     cgroup_path: str
-    uptime_sec: int  # Renamed for Prometheus
     # Container/Orchestration
     runtime: str = "host"
     container_id: str = ""
@@ -39,173 +68,331 @@ class ProcessMetric:
     namespace: str = ""
     # Ranking & Metadata
     rank: int = 0
-    node_name: str = ""
-
-# Timeout context for subprocess
-@contextmanager
-def timeout(seconds):
-    def timeout_handler(signum, frame):
-        raise TimeoutError("Collection timeout")
-    old_handler = signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(seconds)
+    node_name: str = _HOSTNAME
+    # Label text for pid/rank, formatted once by the producer
+    pid_s: str = ""
+    rank_s: str = ""
+
+    # Percentages are stored as ints: exact for collector.sh's %.2f output, values
+    # under 2.56% (most rows) are CPython's shared small ints, and ranking keys
+    # compare ints instead of floats. Widen only for display.
+    @property
+    def cpu_pct(self) -> float:
+        return self.cpu_pct_q / 100
+
+    @property
+    def mem_pct(self) -> float:
+        return self.mem_pct_q / 100
+
+# Public record shape for JSON output: cpu_pct_q → cpu_pct, mem_pct_q → mem_pct
+_OUTPUT_FIELDS = tuple(
+    f.removesuffix('_q') for f in ProcessMetric.__slots__ if f not in ('pid_s', 'rank_s')
+)
+
+def _truncate(value: str, limit: int) -> str:
+    # collector.sh already caps most fields; only slice (and allocate) when needed
+    return value if len(value) <= limit else value[:limit]
+
+def _row_to_metric(parts: List[str]) -> ProcessMetric:
+    """Build a ProcessMetric from one collector.sh TSV row (fields arrive unpadded)"""
+    return ProcessMetric(
+        int(parts[0]),
+        sys.intern(parts[1]),  # few distinct users: share one str per name
+        round(float(parts[2]) * 100),
+        round(float(parts[3]) * 100),
+        int(parts[4]),
+        int(parts[5]),
+        _truncate(parts[6], LABEL_VALUE_MAX),
+        int(parts[7]),
+        int(parts[8]),
+        parts[9] or None,  # Empty → conditional label skip
+        _truncate(parts[10], CGROUP_PATH_MAX),
+        pid_s=parts[0],  # already the decimal text
+    )
+
+def _row_score(parts: List[str]) -> float:
+    """cpu% + mem% straight from a TSV row; rows that parsing would drop score lowest"""
+    if len(parts) < TSV_COLUMNS or parts[6].startswith('[') or parts[0] == '0':
+        return -1.0
+    if not all(parts[i].isdigit() for i in _INT_COLUMNS):
+        return -1.0
+    try:
+        return float(parts[2]) + float(parts[3])
+    except ValueError:
+        return -1.0
+
+def _parse_rows_checked(rows: List[List[str]]) -> List[ProcessMetric]:
+    """Slow path: validate each row and report the ones that can't be parsed"""
+    parsed = []
+    for line_num, parts in enumerate(rows, 1):
+        if len(parts) < TSV_COLUMNS:
+            line = '\t'.join(parts)
+            print(f"Line {line_num} invalid ({len(parts)} fields): {line}", file=sys.stderr)
+            continue
+        try:
+            parsed.append(_row_to_metric(parts))
+        except (ValueError, OverflowError) as e:
+            print(f"Line {line_num} parse error: {e}", file=sys.stderr)
+    return parsed
+
+def _run_collector() -> List[List[str]]:
+    """Run collector.sh and split its rows as they are streamed"""
+    proc = subprocess.Popen(
+        ['./collector.sh'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        bufsize=1,
+        env=_BASE_ENV,
+        start_new_session=True  # own process group, so a kill reaches awk/lsof children too
+    )
+
+    def _kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    # Watchdog thread instead of SIGALRM: no signal handlers, safe off the main thread
+    expired = threading.Event()
+
+    def _expire():
+        expired.set()
+        _kill()
+
+    watchdog = threading.Timer(TIMEOUT_SEC, _expire)
+    watchdog.start()
     try:
-        yield
+        with proc.stdout:
+            # Rows are split while the shell is still emitting the rest; any
+            # trailing extra columns stay joined in one spare item
+            rows = [
+                line.split('\t', TSV_COLUMNS)
+                for line in (raw.rstrip('\n') for raw in proc.stdout) if line
+            ]
+        returncode = proc.wait()
+    except BaseException:
+        _kill()
+        proc.wait()
+        raise
     finally:
-        signal.alarm(0)
-        signal.signal(signal.SIGALRM, old_handler)
+        watchdog.cancel()
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(proc.args, TIMEOUT_SEC)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+    return rows
+
+def collect_data(max_age: Optional[float] = None) -> List[ProcessMetric]:
+    """Cached collection: scrapes within COLLECTOR_CACHE_TTL share one collector.sh run.
+    max_age overrides the TTL for this call (0 always runs collector.sh)."""
+    ttl = CACHE_TTL if max_age is None else max_age
+    with _LAST_LOCK:
+        if _LAST['data'] and time.monotonic() - _LAST['t'] < ttl:
+            return _LAST['data']
+        data = _collect_uncached()
+        _LAST['t'], _LAST['data'] = time.monotonic(), data
+        return data
 
-def collect_data() -> List[ProcessMetric]:
+def _collect_uncached() -> List[ProcessMetric]:
     """Enhanced data collection with timeout, validation, TOP-N"""
     try:
-        with timeout(TIMEOUT_SEC):
-            result = subprocess.run(
-                ['./collector.sh'], 
-                capture_output=True, 
-                text=True, 
-                check=True,
-                env={**os.environ, 'TOP_N': str(TOP_N), 'FORMAT': 'tsv'}
-            )
-        lines = result.stdout.strip().split('\n')
-    except (subprocess.CalledProcessError, TimeoutError, FileNotFoundError) as e:
+        rows = _run_collector()
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
         print(f"Collector error: {e}", file=sys.stderr)
         return []
 
-    processes = []
-    for line_num, line in enumerate(lines, 1):
-        line = line.strip()
-        if not line:
-            continue
-        
-        parts = line.split('\t')
-        if len(parts) < 11:
-            print(f"Line {line_num} invalid ({len(parts)} fields): {line}", file=sys.stderr)
-            continue
-            
-        try:
-            pid, user, pcpu, pmem, rss, etimes, comm, disk_read, disk_write, ports, cgroup_path = parts[:11]
-            pm = ProcessMetric(
-                pid=int(pid),                
-                user=user.strip(),
-                command=comm.strip(),
-                cpu_pct=float(pcpu) or 0.0,
-                mem_pct=float(pmem) or 0.0,
-                mem_rss_kb=int(rss),
-                disk_read_bytes=int(disk_read),
-                disk_write_bytes=int(disk_write),
-                ports=ports.strip() or None,  # Empty → conditional label skip
-                cgroup_path=cgroup_path.strip()[:500],  # Truncate
-                uptime_sec=int(etimes),
-                node_name=socket.gethostname()
-            )
-        except (ValueError, IndexError) as e:
-            print(f"Line {line_num} parse error: {e}", file=sys.stderr)
-            continue
+    # Rank on the raw columns first so objects, classification and metadata
+    # lookups are only paid for the TOP_N winners
+    if len(rows) > TOP_N:
+        rows = heapq.nlargest(TOP_N, rows, key=_row_score)
 
-        # Enhanced container detection
-        pm.runtime = detect_runtime(pm.cgroup_path)
-        pm.container_id = extract_container_id(pm.cgroup_path, pm.runtime)
-        
-        # Resolve metadata (cached)
-        metadata = resolve_container_metadata(pm.container_id, pm.runtime)
-        for k, v in metadata.items():
-            setattr(pm, k, v)
+    try:
+        parsed = [_row_to_metric(parts) for parts in rows]
+    except (ValueError, OverflowError, IndexError):
+        # Some row is malformed (inf percentages overflow round()): redo row by row so only the bad ones are dropped
+        parsed = _parse_rows_checked(rows)
 
+    processes = []
+    fresh = []  # rows whose pid → cgroup pairing wasn't seen last cycle
+    for pm in parsed:
         # Filter kernel threads, zombies
         if pm.command.startswith('[') or pm.pid == 0:
             continue
-            
+
+        cached = _PID_CACHE.get(pm.pid)
+        if cached is not None and cached[0] == pm.cgroup_path:
+            _, pm.runtime, pm.container_id, pm.container_name, pm.pod_name, pm.namespace = cached
+        else:
+            # Enhanced container detection
+            pm.runtime, full_id = classify(pm.cgroup_path)
+            pm.container_id = full_id[:12]  # label only; lookups keep the full id
+            fresh.append((pm, full_id))
         processes.append(pm)
 
-    return sorted(processes, key=lambda p: p.cpu_pct + p.mem_pct, reverse=True)[:TOP_N]
+    # Resolve metadata once per container, concurrently (cached)
+    containers = list({(full_id, p.runtime) for p, full_id in fresh if full_id})
+    metadata = {
+        key: tuple(sys.intern(_truncate(v, LABEL_VALUE_MAX)) for v in md)
+        for key, md in resolve_metadata_batch(containers).items()
+    }
+    for pm, full_id in fresh:
+        if full_id:
+            pm.container_name, pm.pod_name, pm.namespace = metadata[(full_id, pm.runtime)]
+        _PID_CACHE[pm.pid] = (
+            pm.cgroup_path, pm.runtime, pm.container_id,
+            pm.container_name, pm.pod_name, pm.namespace,
+        )
+
+    # Forget pids that are gone (or fell out of collector.sh's TOP_N)
+    for pid in _PID_CACHE.keys() - {p.pid for p in processes}:
+        del _PID_CACHE[pid]
+
+    return heapq.nlargest(TOP_N, processes, key=lambda p: p.cpu_pct_q + p.mem_pct_q)
 
 # ENHANCED: Multi-runtime container detection
-def detect_runtime(cgroup_path: str) -> str:
-    patterns = {
-        'kubernetes': 'kubepods',
-        'docker': 'docker',
-        'containerd': 'cri-containerd|containerd',
-        'podman': 'libpod',
-        'lxc': 'lxc',
-        'systemd': r'/user\.slice|/system\.slice'
-    }
-    for runtime, pattern in patterns.items():
-        if re.search(pattern, cgroup_path):
-            return runtime
-    return 'host'
-
-# ENHANCED: Robust ID extraction
-def extract_container_id(cgroup_path: str, runtime: str) -> str:
-    patterns = {
-        'docker': [r'docker/([a-f0-9]{12,64})', r'docker-([a-f0-9]{12,})'],
-        'containerd': [r'cri-containerd-([a-f0-9]{12,})'],
-        'kubernetes': [r'cri-containerd-([a-f0-9]{12,})', r'docker-([a-f0-9]{12,})', r'kubepods/[^\s]+/pod[^\s]+/([a-f0-9]{12,})'],
-        'podman': [r'libpod-([a-f0-9]{12,})'],
-        'lxc': [r'lxc/([^/]+)']
-    }
-    
-    if runtime in patterns:
-        for pat in patterns[runtime]:
-            match = re.search(pat, cgroup_path)
-            if match:
-                return match.group(1)[:12]
-    return ''
+# Runtime markers are fixed substrings; plain `in` checks beat a regex scan.
+# First runtime present wins (a docker scope under kubepods is kubernetes).
+_RUNTIME_MARKERS = (
+    ('kubepods', 'kubernetes'),
+    ('docker', 'docker'),
+    ('containerd', 'containerd'),
+    ('libpod', 'podman'),
+    ('lxc', 'lxc'),
+    ('/user.slice', 'systemd'),
+    ('/system.slice', 'systemd'),
+)
+
+# Regex is kept for ID extraction only, one alternation per runtime.
+# Each branch has exactly one capturing group, so m.lastindex points at the ID.
+_PAT_DOCKER = re.compile(r'docker/([a-f0-9]{12,64})|docker-([a-f0-9]{12,})')
+_PAT_CONTAINERD = re.compile(r'cri-containerd-([a-f0-9]{12,})')
+_PAT_K8S = re.compile(
+    r'cri-containerd-([a-f0-9]{12,})'
+    r'|docker-([a-f0-9]{12,})'
+    r'|kubepods/[^\s]+/pod[^\s]+/([a-f0-9]{12,})'
+)
+_PAT_PODMAN = re.compile(r'libpod-([a-f0-9]{12,})')
+_PAT_LXC = re.compile(r'lxc/([^/]+)')
+
+@lru_cache(maxsize=8192)
+def classify(cgroup_path: str) -> Tuple[str, str]:
+    """Return (runtime, full container_id) for a cgroup path"""
+    runtime = 'host'
+    for marker, name in _RUNTIME_MARKERS:
+        if marker in cgroup_path:
+            runtime = name
+            break
+
+    match runtime:
+        case 'kubernetes':
+            pattern = _PAT_K8S
+        case 'docker':
+            pattern = _PAT_DOCKER
+        case 'containerd':
+            pattern = _PAT_CONTAINERD
+        case 'podman':
+            pattern = _PAT_PODMAN
+        case 'lxc':
+            pattern = _PAT_LXC
+        case _:
+            return runtime, ''
+
+    found = pattern.search(cgroup_path)
+    if found:
+        return runtime, found.group(found.lastindex)
+    return runtime, ''
 
 # ENHANCED: Multi-runtime metadata (async-friendly)
+# (container_name, pod_name, namespace) — unpacked straight onto ProcessMetric
+ContainerMetadata = Tuple[str, str, str]
+_NO_METADATA: ContainerMetadata = ('', '', '')
+
 @lru_cache(maxsize=1024)
-def resolve_container_metadata(container_id: str, runtime: str) -> Dict[str, str]:
+def resolve_container_metadata(container_id: str, runtime: str) -> ContainerMetadata:
+    """Return (container_name, pod_name, namespace)"""
     if not container_id or runtime == 'host':
-        return {'container_name': '', 'pod_name': '', 'namespace': ''}
+        return _NO_METADATA
     
-    handlers = {
-        'docker': lambda: _docker_metadata(container_id),
-        'podman': lambda: _podman_metadata(container_id),
-        'lxc': lambda: {'container_name': container_id, 'pod_name': '', 'namespace': ''}
-    }
-    
-    return handlers.get(runtime, lambda: {})()
-
-def _docker_metadata(cid: str) -> Dict[str, str]:
-    for containers_dir in ['/var/lib/docker/containers', '/var/lib/docker/containers']:
-        if os.path.exists(containers_dir):
-            for d in os.listdir(containers_dir):
-                if d.startswith(cid):
-                    try:
-                        with open(os.path.join(containers_dir, d, 'config.v2.json')) as f:
-                            config = json.load(f)
-                            return {'container_name': config.get('Name', '').lstrip('/')}
-                    except:
-                        pass
-    return {}
-
-def _podman_metadata(cid: str) -> Dict[str, str]:
+    if runtime == 'docker':
+        return _docker_metadata(container_id)
+    elif runtime == 'podman':
+        return _podman_metadata(container_id)
+    elif runtime == 'lxc':
+        return (container_id, '', '')
+    return _NO_METADATA
+
+# Lookups are IO-bound (file reads, `podman inspect`), so overlap them
+_METADATA_POOL = ThreadPoolExecutor(max_workers=METADATA_WORKERS, thread_name_prefix='upm-metadata')
+
+def resolve_metadata_batch(keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], ContainerMetadata]:
+    """Resolve (container_id, runtime) pairs in parallel; wallclock is max() not sum()"""
+    if len(keys) < 2:
+        return {k: resolve_container_metadata(*k) for k in keys}
+    return dict(zip(keys, _METADATA_POOL.map(lambda k: resolve_container_metadata(*k), keys)))
+
+def _docker_config_path(cid: str) -> Optional[str]:
+    # A full ID names the directory directly; a short one needs a prefix scan
+    if len(cid) == 64:
+        return os.path.join(DOCKER_CONTAINERS_DIR, cid, 'config.v2.json')
+    try:
+        with os.scandir(DOCKER_CONTAINERS_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(cid):
+                    return os.path.join(entry.path, 'config.v2.json')
+    except OSError:
+        pass
+    return None
+
+def _docker_metadata(cid: str) -> ContainerMetadata:
+    config_path = _docker_config_path(cid)
+    if config_path is None:
+        return _NO_METADATA
+    try:
+        with open(config_path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return _NO_METADATA
+    return (config.get('Name', '').lstrip('/'), '', '')
+
+def _podman_metadata(cid: str) -> ContainerMetadata:
     try:
         result = subprocess.run(['podman', 'inspect', cid, '--format=json'], 
                               capture_output=True, text=True, timeout=3)
         if result.returncode == 0:
             data = json.loads(result.stdout)[0]
-            return {'container_name': data['Name']}
+            return (data['Name'], '', '')
     except:
         pass
-    return {}
+    return _NO_METADATA
 
 # ENHANCED: Smart TOP-N aggregation
+_RANK_TEXT = tuple(str(i) for i in range(TOP_N + 1))
+
 def get_top_n(processes: List[ProcessMetric], key_func, n: int = TOP_N) -> List[ProcessMetric]:
-    """Composite ranking with deduplication"""
-    top = sorted(processes, key=key_func, reverse=True)[:n]
+    """Composite ranking with deduplication (bounded heap, O(K log n))"""
+    top = heapq.nlargest(n, processes, key=key_func)
     for rank, p in enumerate(top, 1):
         p.rank = rank
+        p.rank_s = _RANK_TEXT[rank] if rank < len(_RANK_TEXT) else str(rank)
     return top
 
 def aggregate_top(processes: List[ProcessMetric]) -> Dict[str, List[ProcessMetric]]:
     """Multi-metric TOP-N"""
     return {
-        'memory': get_top_n(processes, lambda p: p.mem_rss_kb * (1 + p.mem_pct)),
-        'cpu': get_top_n(processes, lambda p: p.cpu_pct),
-        'disk_read': get_top_n(processes, lambda p: p.disk_read_bytes),
-        'disk_write': get_top_n(processes, lambda p: p.disk_write_bytes),
-        'combined': get_top_n(processes, lambda p: p.cpu_pct + p.mem_pct * 10)
+        'memory': get_top_n(processes, lambda p: p.mem_rss_kb * (100 + p.mem_pct_q)),
+        'cpu': get_top_n(processes, attrgetter('cpu_pct_q')),
+        'disk_read': get_top_n(processes, attrgetter('disk_read_bytes')),
+        'disk_write': get_top_n(processes, attrgetter('disk_write_bytes')),
+        'combined': get_top_n(processes, lambda p: p.cpu_pct_q + p.mem_pct_q * 10)
     }
 
 if __name__ == "__main__":
     processes = collect_data()
-    print(json.dumps([asdict(p) for p in processes], default=str, indent=2))
+    # Project the slots directly (no asdict() deep copy), with the quantized
+    # percentages widened back to their public float names
+    records = [{f: getattr(p, f) for f in _OUTPUT_FIELDS} for p in processes]
+    if orjson is not None:
+        sys.stdout.buffer.write(orjson.dumps(records, option=orjson.OPT_INDENT_2) + b"\n")
+    else:
+        print(json.dumps(records, indent=2))
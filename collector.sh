@@ -4,7 +4,8 @@
 #
 # Output (TSV):
 # pid user cpu_pct mem_pct rss_kb uptime_sec comm
-# disk_read_bytes disk_write_bytes ip port cgroup
+# disk_read_bytes disk_write_bytes ports cgroup
+# (column order must match collector.py's ProcessMetric field order)
 #
 # Supports: TSV / JSON
 # Safe for: cron, exporters, Loki, Prometheus
@@ -9,25 +9,38 @@ UPM Exporter — Unified Process Metrics Exporter
 """
 
 import os
+import re
 import sys
+import zlib
 import time
+import itertools
 import socket
 import signal
 import logging
 import threading
-from typing import Dict, List
+import collections
+from functools import lru_cache
+from operator import attrgetter
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from prometheus_client import (
     Gauge,
     Counter,
     Histogram,
-    generate_latest,
-    CONTENT_TYPE_LATEST,
+    REGISTRY,
 )
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.utils import floatToGoString
 
 try:
-    from collector import collect_data, aggregate_top, ProcessMetric
+    from isal import igzip  # optional: ISA-L (SIMD) gzip, several times faster
+except ImportError:
+    igzip = None
+
+try:
+    from collector import collect_data, aggregate_top, ProcessMetric, _truncate
 except ImportError as e:
     print(f"[FATAL] Failed to import collector: {e}", file=sys.stderr)
     sys.exit(1)
@@ -35,13 +48,28 @@ except ImportError as e:
 # Configuration
 METRICS_PORT = int(os.getenv("METRICS_PORT", "9105"))
 SCRAPE_TIMEOUT = int(os.getenv("SCRAPE_TIMEOUT", "30"))
-
-HOSTNAME = (
-    os.getenv("HOSTNAME")
-    or (open("/host/etc/hostname").read().strip()
-        if os.path.exists("/host/etc/hostname")
-        else socket.gethostname())
-)
+REUSE_PORT = os.getenv("REUSE_PORT", "false").lower() == "true"
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", "5"))
+SCRAPE_INTERVAL = float(os.getenv("SCRAPE_INTERVAL", "0"))
+MAX_SERIES_PER_METRIC = int(os.getenv("MAX_SERIES_PER_METRIC", "2000"))
+CANONICAL_LABELS = os.getenv("CANONICAL_LABELS", "true").lower() == "true"
+COMMAND_HASH_BUCKETS = int(os.getenv("COMMAND_HASH_BUCKETS", "0"))
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "4096"))
+SCRAPE_NICE = int(os.getenv("SCRAPE_NICE", "0"))
+SCRAPE_CPUSET = os.getenv("SCRAPE_CPUSET", "")
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "32"))
+
+def _read_hostname() -> str:
+    """$HOSTNAME, else the host's /etc/hostname (mounted at /host), else gethostname()"""
+    env = os.getenv("HOSTNAME")
+    if env:
+        return env
+    try:
+        return Path("/host/etc/hostname").read_text().strip() or socket.gethostname()
+    except OSError:
+        return socket.gethostname()
+
+HOSTNAME = sys.intern(_read_hostname())
 
 # Parse and normalize label names
 VALID_LABELS = {
@@ -59,41 +87,29 @@ LABEL_ALIASES = {
     "ns": "namespace",
 }
 
+# Accepted spelling → canonical label name, one lookup per input
+_RESOLVE: Dict[str, str] = {label: label for label in VALID_LABELS} | LABEL_ALIASES
+
 def normalize_labels(raw_labels: str) -> List[str]:
     """Normalize and validate label names"""
-    labels = []
-    invalid = []
-    
-    for label in raw_labels.split(","):
-        label = label.strip()
-        if not label:
-            continue
-            
-        # Normalize common variations
-        normalized = LABEL_ALIASES.get(label, label)
-        
-        # Validate against known labels
-        if normalized in VALID_LABELS:
-            if normalized not in labels:  # Avoid duplicates
-                labels.append(normalized)
-        else:
-            invalid.append(label)
-    
+    names = [label.strip() for label in raw_labels.split(",")]
+    invalid = [name for name in names if name and name not in _RESOLVE]
+
     # Log warnings for invalid labels
     if invalid:
         logging.warning(
             f"Invalid label names ignored: {invalid}. "
             f"Valid labels: {sorted(VALID_LABELS)}"
         )
-    
-    return labels
 
-INCLUDE_LABELS = normalize_labels(
-    os.getenv(
-        "INCLUDE_LABELS",
-        "pid,user,command,runtime,rank,container_id,container_name,pod_name,namespace,ports,hostname",
-    )
-)
+    # dict.fromkeys drops duplicates but keeps the configured order
+    return list(dict.fromkeys(_RESOLVE[name] for name in names if name in _RESOLVE))
+
+# pid and container_id churn (pid reuse, redeploys) and would multiply the
+# series count; by default they are only exported on upm_process_info
+DEFAULT_LABELS = "user,command,runtime,rank,container_name,pod_name,namespace,ports,hostname"
+
+INCLUDE_LABELS = normalize_labels(os.getenv("INCLUDE_LABELS", DEFAULT_LABELS))
 
 # Logging
 logging.basicConfig(
@@ -105,12 +121,15 @@ log = logging.getLogger("Exporter")
 
 # Port availability guard (REQUIRED)
 def port_available(port: int) -> bool:
+    """Bind probe on the server's address (no localhost connect attempt).
+    SO_REUSEADDR matches MetricsServer, so TIME_WAIT leftovers don't count."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(("127.0.0.1", port)) != 0
-
-if not port_available(METRICS_PORT):
-    log.error(f"Port {METRICS_PORT} already in use, exiting")
-    sys.exit(1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("0.0.0.0", port))
+        except OSError:
+            return False
+        return True
 
 # Prometheus Metrics
 SCRAPE_DURATION = Histogram(
@@ -124,96 +143,377 @@ SCRAPE_ERRORS = Counter(
     "Total scrape errors",
 )
 
+CARDINALITY_DROPPED = Counter(
+    "upm_cardinality_dropped_total",
+    "Series not exported because a metric hit MAX_SERIES_PER_METRIC",
+    ["metric"],
+)
+
 PROCESSES_TOTAL = Gauge(
     "upm_processes_scraped_total",
     "Processes scraped by runtime",
     ["runtime"],
 )
 
-PROCESS_CPU = Gauge(
-    "upm_process_top_cpu_percent",
-    "Top processes by CPU usage (%)",
-    INCLUDE_LABELS,
+# Process metric families. Each refresh is one point-in-time snapshot, so
+# their exposition text is formatted directly rather than through Gauge children.
+# (name, help, top list the samples come from (None: every listed process), value)
+PROCESS_FAMILIES: Tuple[Tuple[str, str, Optional[str], Callable[[ProcessMetric], float]], ...] = (
+    ("upm_process_top_cpu_percent", "Top processes by CPU usage (%)", "cpu", attrgetter("cpu_pct")),
+    ("upm_process_top_memory_bytes", "Top processes by RSS memory (bytes)", "memory", lambda p: p.mem_rss_kb * 1024),
+    ("upm_process_top_memory_percent", "Top processes by memory (%)", "memory", attrgetter("mem_pct")),
+    ("upm_process_top_disk_read_bytes", "Top processes by disk read bytes", "disk_read", attrgetter("disk_read_bytes")),
+    ("upm_process_top_disk_write_bytes", "Top processes by disk write bytes", "disk_write", attrgetter("disk_write_bytes")),
+    ("upm_process_uptime_seconds", "Process uptime in seconds", None, attrgetter("uptime_sec")),
 )
-
-PROCESS_MEM_BYTES = Gauge(
-    "upm_process_top_memory_bytes",
-    "Top processes by RSS memory (bytes)",
-    INCLUDE_LABELS,
+TOP_LISTS = ("cpu", "memory", "disk_read", "disk_write")
+
+# One series per label block carrying the high-churn identifiers on top of the
+# families' own labels, so the match is one-to-one:
+#   upm_process_top_cpu_percent * ignoring(pid, container_id)
+#     group_left(pid, container_id) upm_process_info
+PROCESS_INFO = ("upm_process_info", "Identifiers of the listed processes (always 1)")
+_INFO_TEXT = (
+    f"# HELP {PROCESS_INFO[0]} {PROCESS_INFO[1]}\n# TYPE {PROCESS_INFO[0]} gauge\n".encode(),
+    f"{PROCESS_INFO[0]}{{".encode(),
 )
 
-PROCESS_MEM_PERCENT = Gauge(
-    "upm_process_top_memory_percent",
-    "Top processes by memory (%)",
-    INCLUDE_LABELS,
+# Helpers
+# Canonical label values: generated parts of names make every instance a new
+# series. Numeric suffixes of commands (worker-0123, app.42) are dropped, but
+# digits inside a name (x86_64-gcc, sha256sum, python3.11) are kept; pod
+# names lose their controller suffixes (<deploy>-<rs hash>-<id>, <ds>-<id>,
+# <sts>-<ordinal>); k8s ids use a vowel-free alphabet, so real words survive.
+# Canonical commands are also capped, so long argv-like names can't fan out.
+CANONICAL_COMMAND_MAX = 32
+_NUMERIC_SUFFIX = re.compile(r"(?<![\d._-])(?:[-_.]?\d{2,})+$")
+_POD_SUFFIX = re.compile(
+    r"(?:-[bcdfghjklmnpqrstvwxz2456789]{6,10})?-[bcdfghjklmnpqrstvwxz2456789]{5}$|-\d+$"
 )
 
-PROCESS_DISK_READ = Gauge(
-    "upm_process_top_disk_read_bytes",
-    "Top processes by disk read bytes",
-    INCLUDE_LABELS,
-)
 
-PROCESS_DISK_WRITE = Gauge(
-    "upm_process_top_disk_write_bytes",
-    "Top processes by disk write bytes",
-    INCLUDE_LABELS,
-)
+@lru_cache(maxsize=4096)
+def canonical_command(command: str) -> str:
+    """command without its numeric suffix, capped at CANONICAL_COMMAND_MAX; folded into
+    COMMAND_HASH_BUCKETS buckets when set"""
+    canon = _truncate(_NUMERIC_SUFFIX.sub("", command) or command, CANONICAL_COMMAND_MAX)
+    if COMMAND_HASH_BUCKETS:
+        return "h:" + format(zlib.crc32(canon.encode()) % COMMAND_HASH_BUCKETS, "x")
+    return canon
+
+
+@lru_cache(maxsize=4096)
+def canonical_pod(pod_name: str) -> str:
+    """Workload name of a pod (controller-generated suffix removed)"""
+    return _POD_SUFFIX.sub("", pod_name) or pod_name
+
+
+# Label name → value expression over p. The collector already caps string
+# lengths (LABEL_VALUE_MAX, 12-char container ids) and interns repeated values.
+_LABEL_SOURCE: Dict[str, str] = {
+    "pid": "(p.pid_s or str(p.pid))",
+    "user": "p.user",
+    "command": "canonical_command(p.command)" if CANONICAL_LABELS else "p.command",
+    "runtime": "p.runtime",
+    "rank": "(p.rank_s or str(p.rank))",
+    "container_id": "p.container_id",
+    "container_name": "p.container_name",
+    "pod_name": "canonical_pod(p.pod_name)" if CANONICAL_LABELS else "p.pod_name",
+    "namespace": "p.namespace",
+    "ports": '(str(p.ports) if p.ports else "")',
+    "hostname": "HOSTNAME",
+}
+
+
+def _compile_labels_for(names: List[str]) -> Callable[[ProcessMetric], Tuple[str, ...]]:
+    """Build labels_for with only the enabled labels inlined (INCLUDE_LABELS is fixed)"""
+    src = "def labels_for(p):\n    return (" + "".join(_LABEL_SOURCE[n] + ", " for n in names) + ")\n"
+    namespace = {
+        "HOSTNAME": HOSTNAME,
+        "canonical_command": canonical_command,
+        "canonical_pod": canonical_pod,
+    }
+    exec(compile(src, "<labels_for>", "exec"), namespace)
+    fn = namespace["labels_for"]
+    fn.__doc__ = "Label values in INCLUDE_LABELS order"
+    return fn
+
+
+labels_for = _compile_labels_for(INCLUDE_LABELS)
+
+
+# One {} slot per enabled label, e.g. pid="{}",user="{}"
+_LABEL_TEMPLATE = ",".join(f'{name}="{{}}"' for name in INCLUDE_LABELS)
+# Identifier labels upm_process_info adds (those not already in the block)
+_INFO_IDS = [name for name in ("pid", "container_id") if name not in INCLUDE_LABELS]
+_INFO_TEMPLATE = "".join(f',{name}="{{}}"' for name in _INFO_IDS)
+
+
+def escape_label_value(value: str) -> str:
+    """Text-format escaping (backslash, newline, double quote); usually a no-op"""
+    if "\\" in value or "\n" in value or '"' in value:
+        return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+    return value
+
 
-PROCESS_UPTIME = Gauge(
-    "upm_process_uptime_seconds",
-    "Process uptime in seconds",
-    INCLUDE_LABELS,
+def label_block(labels: Tuple[str, ...]) -> bytes:
+    """The text between {} for one labels_for() tuple"""
+    return _LABEL_TEMPLATE.format(*map(escape_label_value, labels)).encode()
+
+
+def info_ids(p: ProcessMetric) -> bytes:
+    """The ,pid="..",container_id=".." suffix appended to p's label block"""
+    ids = {"pid": p.pid_s or str(p.pid), "container_id": p.container_id}
+    return _INFO_TEMPLATE.format(*(ids[name] for name in _INFO_IDS)).encode()
+
+
+# labels_for() tuple → encoded block, as of the previous refresh. Top lists
+# are mostly stable, so most blocks carry over; vanished ones are dropped
+# by rebuilding the map each refresh (refreshes hold _SCRAPE_LOCK).
+_BLOCKS: Dict[Tuple[str, ...], bytes] = {}
+
+
+# Fixed text per family, encoded once: (HELP/TYPE header, b"name{")
+_FAMILY_TEXT: Tuple[Tuple[bytes, bytes], ...] = tuple(
+    (f"# HELP {name} {help_text}\n# TYPE {name} gauge\n".encode(), f"{name}{{".encode())
+    for name, help_text, _, _ in PROCESS_FAMILIES
 )
 
 
-ALL_METRICS = [
-    PROCESS_CPU,
-    PROCESS_MEM_BYTES,
-    PROCESS_MEM_PERCENT,
-    PROCESS_DISK_READ,
-    PROCESS_DISK_WRITE,
-    PROCESS_UPTIME,
-]
+def format_process_metrics(tops: Dict[str, List[ProcessMetric]]) -> bytes:
+    """Exposition text for PROCESS_FAMILIES from one aggregate_top() result"""
+    lists = {name: tops.get(name, []) for name in TOP_LISTS}
+    union = list({p.pid: p for ps in lists.values() for p in ps}.values())
+    global _BLOCKS
+    previous, current = _BLOCKS, {}
+    blocks: Dict[int, bytes] = {}
+    for p in union:
+        labels = labels_for(p)
+        block = current.get(labels) or previous.get(labels) or label_block(labels)
+        current[labels] = blocks[p.pid] = block
+    _BLOCKS = current
+
+    # Assembled from pre-encoded fragments and joined once
+    out: List[bytes] = []
+    for (header, prefix), (name, _, source, value) in zip(_FAMILY_TEXT, PROCESS_FAMILIES):
+        # Keyed by label block: processes that only differ in a disabled
+        # label collapse to one series (last wins, as Gauge.set did)
+        samples = {blocks[p.pid]: value(p) for p in (union if source is None else lists[source])}
+        if len(samples) > MAX_SERIES_PER_METRIC:
+            # Lists are rank-ordered, so the highest-ranked series are kept
+            CARDINALITY_DROPPED.labels(name).inc(len(samples) - MAX_SERIES_PER_METRIC)
+            samples = dict(itertools.islice(samples.items(), MAX_SERIES_PER_METRIC))
+        out.append(header)
+        for block, v in samples.items():
+            out += (prefix, block, b"} ", floatToGoString(v).encode("ascii"), b"\n")
+
+    # Same keying as the families (last wins per block), so each family
+    # series matches exactly one info series
+    info = {blocks[p.pid]: p for p in union}
+    if len(info) > MAX_SERIES_PER_METRIC:
+        CARDINALITY_DROPPED.labels(PROCESS_INFO[0]).inc(len(info) - MAX_SERIES_PER_METRIC)
+        info = dict(itertools.islice(info.items(), MAX_SERIES_PER_METRIC))
+    header, prefix = _INFO_TEXT
+    out.append(header)
+    for block, p in info.items():
+        out += (prefix, block, info_ids(p), b"} 1.0\n")
+    return b"".join(out)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """True if an Accept-Encoding header allows gzip (and doesn't set q=0)"""
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "gzip":
+            continue
+        _, _, q = params.partition("q=")
+        try:
+            return float(q) > 0 if q else True
+        except ValueError:
+            return True
+    return False
+
+# Runtime counts published by the previous refresh
+_LAST_RUNTIME_COUNTS: Dict[str, int] = {}
+
+def refresh_metrics(max_age: Optional[float] = None) -> bytes:
+    """Collect processes, update the runtime gauge and format the process families.
+    max_age is passed to collect_data (None: COLLECTOR_CACHE_TTL)."""
+    processes = collect_data(max_age)
+    if not processes:
+        log.warning("No processes collected")
+        return b""
+
+    # Runtime counters (collections.Counter: prometheus_client's Counter is imported here)
+    runtime_counts = collections.Counter(map(attrgetter("runtime"), processes))
+
+    if len(runtime_counts) > MAX_SERIES_PER_METRIC:
+        # A runaway runtime classification must not grow the gauge unbounded
+        CARDINALITY_DROPPED.labels("upm_processes_scraped_total").inc(
+            len(runtime_counts) - MAX_SERIES_PER_METRIC
+        )
+        runtime_counts = collections.Counter(dict(runtime_counts.most_common(MAX_SERIES_PER_METRIC)))
+
+    # Only touch changed runtimes, and drop runtimes that disappeared
+    for rt, count in runtime_counts.items():
+        if _LAST_RUNTIME_COUNTS.get(rt) != count:
+            PROCESSES_TOTAL.labels(runtime=rt).set(count)
+    for rt in _LAST_RUNTIME_COUNTS.keys() - runtime_counts.keys():
+        PROCESSES_TOTAL.remove(rt)
+    _LAST_RUNTIME_COUNTS.clear()
+    _LAST_RUNTIME_COUNTS.update(runtime_counts)
+
+    return format_process_metrics(aggregate_top(processes))
+
+
+# Gauges are shared by all handler threads, so filling and rendering them is
+# serialised. The rendered body is kept for METRICS_CACHE_TTL so scrape storms
+# don't re-collect or re-compress. Bodies are keyed (format, encoding): every
+# format in _FORMATS is rendered with the snapshot, from one registry state;
+# only the gzip variants are built lazily on first request.
+# With SCRAPE_INTERVAL set, SnapshotRefresher renders it in the background
+# and scrapes only ever read the current snapshot.
+_SCRAPE_LOCK = threading.Lock()
+_RENDERED: Dict[str, Any] = {"t": 0.0}
+# Snapshot ids: per-start prefix so validators don't repeat across restarts
+_EPOCH = format(time.time_ns(), "x")
+_SNAPSHOT_IDS = itertools.count(1)
+# Offered formats → (registry encoder, content type). "text" is what a
+# scraper sending no Accept header gets; Prometheus asks for OpenMetrics.
+_FORMATS: Dict[str, Tuple[Callable, str]] = {
+    "text": choose_encoder(""),
+    "openmetrics": choose_encoder("application/openmetrics-text; version=1.0.0"),
+}
 
-# Helpers
-def labels_for(p: ProcessMetric) -> Dict[str, str]:
-    """Build label dict with strict cardinality control and validation"""
-    # All possible labels with their values
-    all_labels = {
-        "pid": str(p.pid),
-        "user": p.user or "",
-        "command": (p.command or "")[:64],
-        "runtime": p.runtime or "",
-        "rank": str(p.rank),
-        "container_id": (p.container_id or "")[:12],
-        "container_name": (p.container_name or "")[:64],
-        "pod_name": (p.pod_name or "")[:64],
-        "namespace": (p.namespace or "")[:64],
-        "ports": str(p.ports) if p.ports else "",
-        "hostname": HOSTNAME,
-    }
-    
-    # Only return labels that are in INCLUDE_LABELS
-    result = {k: v for k, v in all_labels.items() if k in INCLUDE_LABELS}
-    
-    # Defensive check: ensure we're not missing any expected labels
-    missing = set(INCLUDE_LABELS) - set(result.keys())
-    if missing:
-        log.warning(f"Missing labels in labels_for: {missing}. This shouldn't happen.")
-        # Fill missing labels with empty strings to prevent errors
-        for label in missing:
-            result[label] = ""
-    
-    return result
+# Level 1: several times cheaper than 6 on exposition text, little size cost.
+# wbits=31 gives the gzip wrapper; each body gets a copy of this compressor.
+_GZIP_TEMPLATE = zlib.compressobj(1, zlib.DEFLATED, 31)
+
+
+def compress_gzip(data: bytes) -> bytes:
+    """gzip member for data: ISA-L when installed, else a copy of the shared compressor"""
+    if igzip is not None:
+        return igzip.compress(data, compresslevel=1)
+    c = _GZIP_TEMPLATE.copy()
+    return c.compress(data) + c.flush()
+
+
+def _render_locked(max_age: Optional[float] = None) -> Dict[str, Any]:
+    """Collect and publish a newly rendered snapshot (_SCRAPE_LOCK held)"""
+    global _RENDERED
+    # Timed here, not per request: cache hits and 304s would swamp it, and
+    # with SCRAPE_INTERVAL the collection doesn't happen in a request at all
+    start = time.perf_counter()
+    try:
+        process_text = refresh_metrics(max_age)
+    finally:
+        SCRAPE_DURATION.observe(time.perf_counter() - start)
+    # Replaced whole, so lock-free readers never see a half-built snapshot.
+    # The body changes every render (scrape histogram, process stats), so a
+    # sequence number is as good a validator as a content hash, and free.
+    snap: Dict[Any, Any] = {"t": time.monotonic(), "id": f"{_EPOCH}-{next(_SNAPSHOT_IDS)}"}
+    for fmt, (encoder, content_type) in _FORMATS.items():
+        snap[(fmt, "identity")] = render_exposition(process_text, encoder, content_type)
+    _RENDERED = snap
+    return snap
+
+
+def render_snapshot(max_age: Optional[float] = None) -> Dict[str, Any]:
+    with _SCRAPE_LOCK:
+        return _render_locked(max_age)
+
+
+def current_snapshot() -> Dict[str, Any]:
+    """Snapshot to serve: the background one, or a cached/fresh on-demand render"""
+    snap = _RENDERED
+    if SCRAPE_INTERVAL > 0 and "id" in snap:
+        if time.monotonic() - snap["t"] > 2 * SCRAPE_INTERVAL:
+            # Refresher is stuck or failing; serve the old data but count it
+            SCRAPE_ERRORS.inc()
+            log.warning("Serving stale snapshot (%.0fs old)", time.monotonic() - snap["t"])
+        return snap
+    if "id" in snap and time.monotonic() - snap["t"] < METRICS_CACHE_TTL:
+        return snap
+    with _SCRAPE_LOCK:
+        snap = _RENDERED
+        if "id" in snap and time.monotonic() - snap["t"] < METRICS_CACHE_TTL:
+            return snap  # rendered by a concurrent scrape while we waited
+        return _render_locked()
+
+
+def render_exposition(process_text: bytes, encoder: Callable, content_type: str) -> bytes:
+    """Registry metrics in one format, plus the process families.
+    Their hand-formatted gauge lines are valid in both text and OpenMetrics."""
+    body = encoder(REGISTRY)
+    if content_type.startswith("application/openmetrics-text"):
+        # OpenMetrics ends with "# EOF"; the process families go before it
+        return body.removesuffix(b"# EOF\n") + process_text + b"# EOF\n"
+    return body + process_text
+
+
+def negotiate_format(accept: str) -> str:
+    """Key into _FORMATS for an Accept header (choose_encoder decides)"""
+    _, content_type = choose_encoder(accept)
+    return "openmetrics" if content_type.startswith("application/openmetrics-text") else "text"
+
+
+def snapshot_etag(snap: Dict[str, Any], fmt: str, encoding: str) -> str:
+    """Weak validator for one representation (format, encoding) of a snapshot"""
+    suffix = "" if fmt == "text" else "-" + fmt
+    if encoding != "identity":
+        suffix += "-" + encoding
+    return f'W/"{snap["id"]}{suffix}"'
+
+
+def snapshot_body(snap: Dict[str, Any], fmt: str, encoding: str) -> bytes:
+    key = (fmt, encoding)
+    body = snap.get(key)
+    if body is None:
+        # Only gzip variants are built lazily; the plain bodies come with the snapshot
+        body = compress_gzip(snap[(fmt, "identity")])
+        # Concurrent first requests may both compress; the result is identical
+        snap[key] = body
+    return body
+
+
+class SnapshotRefresher(threading.Thread):
+    """Collects and renders every SCRAPE_INTERVAL seconds, off the scrape path"""
+
+    def __init__(self, interval: float):
+        super().__init__(name="refresher", daemon=True)
+        self.interval = interval
+
+    def run(self):
+        while not shutdown_flag.is_set():
+            try:
+                # Bypass the collector cache: each tick is a fresh collection,
+                # whatever COLLECTOR_CACHE_TTL says
+                render_snapshot(max_age=0)
+            except Exception:
+                SCRAPE_ERRORS.inc()
+                log.exception("Background refresh failed")
+            shutdown_flag.wait(self.interval)
 
 
-def clear_metrics():
-    for m in ALL_METRICS:
-        m.clear()
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for it)"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
 
 # HTTP Handler
 class MetricsHandler(BaseHTTPRequestHandler):
+    # TCP_NODELAY, and buffer the response so status line, headers and a
+    # typical body go out together (flushed by handle_one_request/finish)
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+    # Keep-alive: scrapers reuse one connection instead of a handshake per
+    # scrape. Every response must then carry a Content-Length. Idle
+    # connections are closed after `timeout` seconds, freeing their thread.
+    protocol_version = "HTTP/1.1"
+    timeout = 120
+
     def log_message(self, format, *args):
         return
 
@@ -224,63 +524,52 @@ class MetricsHandler(BaseHTTPRequestHandler):
             self._handle_ok()
         else:
             self.send_response(404)
+            self.send_header("Content-Length", "0")
             self.end_headers()
 
     def _handle_ok(self):
         self.send_response(200)
         self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", "3")
         self.end_headers()
         self.wfile.write(b"OK\n")
 
     def _handle_metrics(self):
-        with SCRAPE_DURATION.time():
-            try:
-                processes = collect_data()
-                if not processes:
-                    log.warning("No processes collected")
-                    self._write_metrics()
-                    return
-
-                # Runtime counters
-                runtime_counts: Dict[str, int] = {}
-                for p in processes:
-                    runtime_counts[p.runtime] = runtime_counts.get(p.runtime, 0) + 1
-
-                for rt, count in runtime_counts.items():
-                    PROCESSES_TOTAL.labels(runtime=rt).set(count)
-
-                clear_metrics()
-                tops = aggregate_top(processes)
-
-                for p in tops.get("cpu", []):
-                    PROCESS_CPU.labels(**labels_for(p)).set(p.cpu_pct)
-                    PROCESS_UPTIME.labels(**labels_for(p)).set(p.uptime_sec)
-
-                for p in tops.get("memory", []):
-                    PROCESS_MEM_BYTES.labels(**labels_for(p)).set(p.mem_rss_kb * 1024)
-                    PROCESS_MEM_PERCENT.labels(**labels_for(p)).set(p.mem_pct)
-                    PROCESS_UPTIME.labels(**labels_for(p)).set(p.uptime_sec)
-
-                for p in tops.get("disk_read", []):
-                    PROCESS_DISK_READ.labels(**labels_for(p)).set(p.disk_read_bytes)
-                    PROCESS_UPTIME.labels(**labels_for(p)).set(p.uptime_sec)
-
-                for p in tops.get("disk_write", []):
-                    PROCESS_DISK_WRITE.labels(**labels_for(p)).set(p.disk_write_bytes)
-                    PROCESS_UPTIME.labels(**labels_for(p)).set(p.uptime_sec)
-
-                self._write_metrics()
-
-            except Exception as e:
-                SCRAPE_ERRORS.inc()
-                log.exception("Metrics scrape failed")
-                self.send_error(500, str(e))
-
-    def _write_metrics(self):
+        try:
+            fmt = negotiate_format(self.headers.get("Accept", ""))
+            snap = current_snapshot()
+            plain = snap[(fmt, "identity")]
+            # Small bodies aren't worth the compression (or the client's inflate)
+            gzip_ok = len(plain) > GZIP_MIN_BYTES and accepts_gzip(self.headers.get("Accept-Encoding", ""))
+            encoding = "gzip" if gzip_ok else "identity"
+            etag = snapshot_etag(snap, fmt, encoding)
+            # Unchanged snapshot: answer before any compression or body write
+            if etag_matches(self.headers.get("If-None-Match", ""), etag):
+                self.send_response(304)
+                self._send_validators(etag)
+                self.end_headers()
+                return
+            self._write_metrics(snapshot_body(snap, fmt, encoding), _FORMATS[fmt][1], encoding, etag)
+
+        except Exception as e:
+            SCRAPE_ERRORS.inc()
+            log.exception("Metrics scrape failed")
+            self.send_error(500, str(e))
+
+    def _send_validators(self, etag: str):
+        # Shared by 200 and 304: a 304 must repeat the 200's Vary (RFC 9110 15.4.5)
+        self.send_header("Vary", "Accept, Accept-Encoding")
+        self.send_header("ETag", etag)
+
+    def _write_metrics(self, body: bytes, content_type: str, encoding: str, etag: str):
         self.send_response(200)
-        self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.send_header("Content-Type", content_type)
+        self._send_validators(etag)
+        if encoding == "gzip":
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(generate_latest())
+        self.wfile.write(body)
 
 # Server
 shutdown_flag = threading.Event()
@@ -289,12 +578,77 @@ def shutdown_handler(signum, frame):
     log.info("Shutdown signal received")
     shutdown_flag.set()
 
-signal.signal(signal.SIGTERM, shutdown_handler)
-signal.signal(signal.SIGINT, shutdown_handler)
+class MetricsServer(ThreadingHTTPServer):
+    """One thread per connection, so /health never queues behind a slow scrape.
+    At most MAX_CONNECTIONS are served at once (idle keep-alive connections
+    included); connections over the cap are closed on accept."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()  # worker thread never started
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+    def server_bind(self):
+        if REUSE_PORT:
+            # Several exporter processes may share the port; the kernel
+            # load-balances incoming scrapes across them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def parse_cpuset(spec: str) -> Set[int]:
+    """CPU list in cpuset syntax, e.g. "0,2-3" → {0, 2, 3}"""
+    cpus: Set[int] = set()
+    for part in filter(None, (x.strip() for x in spec.split(","))):
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def limit_footprint():
+    """Lower priority / pin CPUs so scrapes don't compete with the workload.
+    collector.sh and its children inherit both settings."""
+    if SCRAPE_NICE:
+        try:
+            log.info("Niceness: %d", os.nice(SCRAPE_NICE))
+        except OSError as e:  # negative increments need CAP_SYS_NICE
+            log.warning(f"Ignoring SCRAPE_NICE={SCRAPE_NICE}: {e}")
+    if SCRAPE_CPUSET:
+        try:
+            os.sched_setaffinity(0, parse_cpuset(SCRAPE_CPUSET))
+            log.info("CPU affinity: %s", sorted(os.sched_getaffinity(0)))
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring SCRAPE_CPUSET={SCRAPE_CPUSET!r}: {e}")
 
 def run():
-    server = HTTPServer(("0.0.0.0", METRICS_PORT), MetricsHandler)
-    server.timeout = 1
+    # Port probe and signal handlers live here rather than at import, so
+    # importing the module (REPL, tests, other threads) neither touches the
+    # port nor takes over SIGINT/SIGTERM. With REUSE_PORT a bound port is expected (another
+    # exporter sharing it). The bind itself still decides: the port can be
+    # taken between probe and server start.
+    if not REUSE_PORT and not port_available(METRICS_PORT):
+        log.error(f"Port {METRICS_PORT} already in use, exiting")
+        sys.exit(1)
+    try:
+        server = MetricsServer(("0.0.0.0", METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        log.error(f"Cannot bind port {METRICS_PORT}: {e}")
+        sys.exit(1)
 
     log.info("UPM Exporter started")
     log.info("Port: %d", METRICS_PORT)
@@ -306,8 +660,19 @@ def run():
         log.error("No valid labels configured! Metrics will fail.")
         sys.exit(1)
 
-    while not shutdown_flag.is_set():
-        server.handle_request()
+    limit_footprint()
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+
+    if SCRAPE_INTERVAL > 0:
+        log.info("Background refresh every %gs", SCRAPE_INTERVAL)
+        SnapshotRefresher(SCRAPE_INTERVAL).start()
+
+    # Serve from a worker thread; the main thread just waits for a signal
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    shutdown_flag.wait()
+    server.shutdown()
+    server.server_close()
 
     log.info("Exporter stopped")
 